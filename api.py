@@ -1,57 +1,253 @@
 # Import required modules.
 import requests
-import pytz
-import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
 import time
 
-# Pacific timezone used for setting the Yelp API quota refresh time.
-zone = pytz.timezone('America/Los_Angeles')
+# Decode responses with orjson where available, which is considerably faster
+# than the json module for large search results.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
+# Logger used to report failed queries.
+logger = logging.getLogger(__name__)
 
-# Function to query url and convert json to dict.
-def url_query(url, params=None, headers=None, reqtype='get', repeat=0):
+# Yelp Fusion API urls.
+token_url = 'https://api.yelp.com/oauth2/token'
+api_url = 'https://api.yelp.com/v3'
+autocomplete_url = api_url + '/autocomplete'
+business_url = api_url + '/businesses'
+search_url = business_url + '/search'
+phone_search_url = search_url + '/phone'
+transactions_url = api_url + '/transactions'
 
-    # Attempt GET or POST request for given parameters and headers.
-    try:
+# Maximum age in seconds of a cached access token before a new one is
+# requested (Yelp access tokens expire after 180 days).
+token_max_age = 150 * 24 * 60 * 60
+
+# Maximum number of search result pages to request concurrently.
+max_workers = 10
+
+# Maximum number of seconds to back off for when rate limited.
+max_backoff = 300
+
+# Maximum number of responses to cache, and number of seconds to cache
+# responses for by endpoint.
+cache_size = 4096
+details_ttl = 300
+search_ttl = 120
+transaction_ttl = 60
+
+
+class CappedRetry(Retry):
+    """
+    Retry policy capping each back off, including any Retry-After header
+    sent with a rate limited response, at max_backoff seconds. The waits are
+    capped here rather than through keyword arguments, as those differ across
+    the urllib3 versions supported by requests.
+
+    """
+
+    def get_backoff_time(self):
+        return min(super(CappedRetry, self).get_backoff_time(), max_backoff)
+
+    def get_retry_after(self, response):
+        retry_after = super(CappedRetry, self).get_retry_after(response)
+        if retry_after is not None:
+            retry_after = min(retry_after, max_backoff)
+        return retry_after
+
+
+class TokenBucket(object):
+    def __init__(self, capacity, refill_rate):
+        """
+        Client-side rate limiter, pacing queries before they are sent so as to
+        stay within the Yelp API rate limit.
+
+        Parameters:
+
+        - capacity (int):
+            Maximum number of queries that may be sent in a single burst.
+
+        - refill_rate (float):
+            Number of queries per second permitted once the burst capacity has
+            been used.
+
+        """
+
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token from the bucket, sleeping until one becomes available if
+        the bucket is empty.
+
+        """
+
+        with self.lock:
+            # Refill for the time elapsed since the last refill, up to the
+            # bucket capacity.
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.last_refill) * self.refill_rate)
+            self.last_refill = now
+
+            # If no token is available, wait for one to be refilled. The lock
+            # is held while sleeping so that waiting callers are served in
+            # turn.
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.refill_rate)
+                self.last_refill = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
+
+
+class ResponseCache(object):
+    def __init__(self, maxsize):
+        """
+        Least recently used cache of raw query responses, with an expiry time
+        for each entry.
+
+        Parameters:
+
+        - maxsize (int):
+            Maximum number of responses to hold, after which the least
+            recently used are discarded.
+
+        """
+
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params=None):
+        """
+        Build a stable cache key for the given url and parameters, given as
+        a dict or a list of (key, value) tuples, by hashing the url with the
+        parameters sorted by key.
+
+        """
+
+        if isinstance(params, dict):
+            params = params.items()
+        query = (url, tuple(sorted(params)) if params else ())
+        return hashlib.blake2b(repr(query).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response for key, or None if it is missing or has
+        expired.
+
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, content = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return content
+
+    def set(self, key, content, ttl):
+        """
+        Cache the response content for key for ttl seconds.
+
+        """
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, content)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+# Function to join list or tuple parameters into a comma delimited string.
+def _join(values):
+    if values is None or isinstance(values, (str, int)):
+        return values
+    return ','.join(map(str, values))
+
+
+# Function to add optional parameters to params, skipping any left unset.
+def _add_opt(params, **kwargs):
+    params.update({k: v for k, v in kwargs.items() if v is not None})
+
+
+# Function to query url and convert json to dict.
+def url_query(url, params=None, headers=None, reqtype='get', session=None,
+              bucket=None, cache=None, ttl=None, refresh=None):
+
+    # Sort the parameters, so that identical queries built in a different
+    # order share a cache entry and are sent identically.
+    if isinstance(params, dict):
+        params = sorted(params.items())
+
+    # Return the cached response, if available, without using any quota.
+    # Raw content is cached so that each caller receives its own copy of the
+    # results to modify.
+    cache_key = None
+    if cache is not None and ttl and reqtype.lower() == 'get':
+        cache_key = cache.key(url, params)
+        content = cache.get(cache_key)
+        if content is not None:
+            return json_loads(content)
+
+    # Attempt GET or POST request for given parameters and headers, reusing
+    # the pooled connections of the session where one is provided, and
+    # waiting for the rate limiter, if provided, before sending the query.
+    if session is None:
+        session = requests
+
+    def send():
+        if bucket is not None:
+            bucket.acquire()
         if reqtype.lower() == 'get':
-            if params is not None:
-                request = requests.get(url, params, headers=headers, timeout=30)
-            else:
-                request = requests.get(url, headers=headers, timeout=30)
+            return session.get(url, params=params, headers=headers,
+                               timeout=30)
         elif reqtype.lower() == 'post':
-            request = requests.post(url, params, timeout=30)
+            return session.post(url, params, timeout=30)
+
+    # Failed connections, server errors and rate limiting are retried with
+    # exponential back off by the session adapter, so any failure remaining
+    # here is final, other than an expired or revoked access token, for which
+    # a new token is requested and the query tried once more.
+    try:
+        request = send()
+        if request.status_code == 401 and refresh is not None:
+            refresh(request)
+            request = send()
         if request.status_code == 200:
-            results = request.json()
+            results = json_loads(request.content)
+            if cache_key is not None:
+                cache.set(cache_key, request.content, ttl)
             return results
+        request.raise_for_status()
 
-        # If over quota limit, determine Yelps quota limit refresh time, and
-        # sleep until then.
-        elif request.status_code == 429:
-            start = datetime.datetime.now(zone)
-            end = datetime.datetime(start.year, start.month, start.day, tzinfo=start.tzinfo)
-            end += datetime.timedelta(days=1)
-            wait = end - start
-            seconds = wait.seconds + 60
-            resume = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
-            resume = resume.strftime('%Y-%m-%d %H:%M:%S')
-            print('Over quota limit, sleeping until {0}'.format(resume))
-            time.sleep(seconds)
-            return url_query(url, params, headers, reqtype, repeat)
-        else:
-            request.raise_for_status()
-
-    # Repeat query upon fail up to 5 times (to avoid timeout errors), or print
-    # Exception error if still failing after 5 attempts.
-    except Exception as e:
-        if repeat < 5:
-            repeat += 1
-            return url_query(url, params, headers, reqtype, repeat)
-        else:
-            error = 'Failed on url {0}'.format(url)
+    # Log Exception error if the query failed, redacting the client secret
+    # sent with access token requests.
+    except Exception:
         if params:
-            error += ' with parameters {0}'.format(params)
-        print(error)
-        print(e)
+            params = [(k, '<redacted>' if k == 'client_secret' else v)
+                      for k, v in params]
+        logger.exception('Failed on url %s with parameters %s', url, params)
 
 
 class YelpFusion(object):
@@ -71,16 +267,161 @@ class YelpFusion(object):
 
         """
 
-        # Request access token, and build header for subsequent queries.
-        params = {
-            'grant_type': 'client_credentials',
-            'client_id': client_id,
-            'client_secret': client_secret
-        }
-        request = url_query('https://api.yelp.com/oauth2/token',
-                            params, reqtype='post')
-        token = request['access_token']
+        # Create a session with a keep-alive connection pool, so subsequent
+        # queries reuse open connections rather than repeating the TCP and TLS
+        # handshakes for each call. Failed queries are retried up to 5 times
+        # with exponential back off, honouring any Retry-After header sent
+        # with a rate limited response, with each wait capped at max_backoff
+        # seconds, and the final response returned for url_query to handle.
+        # These retries happen within the adapter, so they are not paced by
+        # the client rate limiter.
+        self.session = requests.Session()
+        retry = CappedRetry(total=5, backoff_factor=0.5,
+                            status_forcelist=(429, 500, 502, 503, 504),
+                            allowed_methods=('GET', 'POST'),
+                            respect_retry_after_header=True,
+                            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50,
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+
+        # Pace queries to stay within the Yelp API queries per second limit.
+        self.bucket = TokenBucket(capacity=5, refill_rate=5)
+
+        # Cache responses, so that repeated queries are served locally.
+        self.cache = ResponseCache(maxsize=cache_size)
+
+        # Reuse the access token cached by a previous client with the same
+        # client_id if it is recent enough, otherwise request a new one, and
+        # build header for subsequent queries.
+        self.client_id = client_id
+        self.client_secret = client_secret
+        digest = hashlib.sha256(client_id.encode('utf-8')).hexdigest()
+        self.token_path = os.path.join(
+            tempfile.gettempdir(), 'yelp_token_{0}.json'.format(digest[:16]))
+        # Where a new token is needed, it is requested in the background, so
+        # that the caller can prepare its first query during the round-trip;
+        # queries wait for the token before being sent.
+        self.headers = {}
+        self.token_lock = threading.RLock()
+        token = self._load_token()
+        if token is not None:
+            self._set_token(token)
+            self.token_request = None
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self.token_request = executor.submit(self._refresh_token)
+            executor.shutdown(wait=False)
+
+    def _load_token(self):
+        """
+        Return the access token cached on disk, or None if it is missing,
+        unreadable or older than token_max_age. The cache file is also
+        ignored unless it is owned by, and only accessible to, the current
+        user, so that a token planted by another user is never used.
+
+        """
+
+        try:
+            info = os.stat(self.token_path)
+            if hasattr(os, 'getuid') and (info.st_uid != os.getuid() or
+                                          info.st_mode & 0o077):
+                return None
+            if time.time() - info.st_mtime > token_max_age:
+                return None
+            with open(self.token_path) as f:
+                return json.load(f)['token']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _set_token(self, token):
+        """
+        Build the authorization header for subsequent queries from token.
+
+        """
+
         self.headers = {'Authorization': 'bearer {0}'.format(token)}
+        self.session.headers.update(self.headers)
+
+    def _refresh_token(self, rejected=None):
+        """
+        Request a new access token, and cache it on disk for reuse by later
+        clients. The cache file is replaced atomically, and is only readable
+        by the current user.
+
+        Refreshes are serialized, so that concurrent queries rejected with the
+        same expired token request only one new token. Where rejected, the
+        response to such a query, is provided, no token is requested if the
+        token has already been replaced since that query was sent.
+
+        """
+
+        with self.token_lock:
+            if rejected is not None:
+                sent = rejected.request.headers.get('Authorization')
+                if sent != self.headers.get('Authorization'):
+                    return
+
+            params = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
+            }
+            request = self._query(token_url, params, reqtype='post')
+            if request is None:
+                raise ValueError('Failed to obtain Yelp access token')
+            token = request['access_token']
+            self._set_token(token)
+            path = None
+            try:
+                fd, path = tempfile.mkstemp(
+                    dir=os.path.dirname(self.token_path))
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'token': token, 'issued_at': time.time()}, f)
+                os.replace(path, self.token_path)
+            except OSError:
+                logger.warning('Failed to cache access token at %s',
+                               self.token_path, exc_info=True)
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+
+    def _await_token(self):
+        """
+        Wait for the access token requested in the background. If that request
+        failed, request a new token instead, so that the client recovers once
+        Yelp can be reached again.
+
+        """
+
+        token_request = self.token_request
+        try:
+            token_request.result()
+        except Exception:
+            with self.token_lock:
+                if self.token_request is token_request:
+                    self._refresh_token()
+        self.token_request = None
+
+    def _query(self, url, params=None, reqtype='get', ttl=None):
+        """
+        Query url through the session, rate limiter and cache of the client,
+        caching the response for ttl seconds if provided, and refreshing the
+        access token if it has expired.
+
+        """
+
+        # Wait for the access token, if still being requested, and report
+        # the query as failed if no token could be obtained.
+        if reqtype == 'get' and self.token_request is not None:
+            try:
+                self._await_token()
+            except Exception:
+                logger.exception('Failed on url %s without access token', url)
+                return None
+        refresh = self._refresh_token if reqtype == 'get' else None
+        return url_query(url, params, reqtype=reqtype, session=self.session,
+                         bucket=self.bucket, cache=self.cache, ttl=ttl,
+                         refresh=refresh)
 
     def autocomplete(self, text, latitude=None, longitude=None, locale=None):
         """
@@ -110,13 +451,11 @@ class YelpFusion(object):
         """
 
         params = {'text': text}
-        if longitude is not None and latitude is not None:
-            params['latitude'] = latitude
-            params['longitude'] = longitude
-        if locale is not None:
-            params['locale'] = locale
-        url = 'https://api.yelp.com/v3/autocomplete'
-        request = url_query(url, params, headers=self.headers)
+        if latitude is None or longitude is None:
+            latitude = longitude = None
+        _add_opt(params, latitude=latitude, longitude=longitude, locale=locale)
+        url = autocomplete_url
+        request = self._query(url, params, ttl=search_ttl)
         return request
 
     def business_details(self, businessid):
@@ -140,8 +479,8 @@ class YelpFusion(object):
 
         """
 
-        url = 'https://api.yelp.com/v3/businesses/{0}'.format(businessid)
-        request = url_query(url, headers=self.headers)
+        url = f'{business_url}/{businessid}'
+        request = self._query(url, ttl=details_ttl)
         return request
 
     def business_reviews(self, businessid, locale=None):
@@ -170,12 +509,9 @@ class YelpFusion(object):
 
         """
 
-        url = 'https://api.yelp.com/v3/businesses/{0}/reviews'.format(businessid)
-        if locale is not None:
-            params = {'locale': locale}
-            request = url_query(url, params, headers=self.headers)
-        else:
-            request = url_query(url, headers=self.headers)
+        url = f'{business_url}/{businessid}/reviews'
+        params = {'locale': locale} if locale is not None else None
+        request = self._query(url, params, ttl=details_ttl)
         return request
 
     def search(self, term=None, location=None, latitude=None, longitude=None,
@@ -275,63 +611,92 @@ class YelpFusion(object):
 
         """
 
-        # Parse input parameters ready for GET request.
+        # Parse input parameters ready for GET request, limiting the first
+        # query to a single page of results.
         if limit > 50:
             maxlimit = limit
             limit = 50
         else:
             maxlimit = None
-        params = {'term': term,
-                  'limit': limit,
-                  'sort_by': sort_by}
-        if location is not None:
-            params['location'] = location
-        else:
-            params['latitude'] = latitude
-            params['longitude'] = longitude
-        if radius is not None:
-            params['radius'] = radius
-        if categories is not None:
-            if type(categories) != str:
-                categories = ','.join(categories)
-            params['categories'] = categories
-        if locale is not None:
-            params['locale'] = locale
-        if offset is not None:
-            params['offset'] = offset
-        if price is not None:
-            if type(price) not in (str, int):
-                price = ','.join(price)
-            params['price'] = price
-        if open_now:
-            params['open_now'] = 'true'
-        elif open_at is not None:
-            params['open_at'] = open_at
-        if attributes is not None:
-            if type(attributes) != str:
-                attributes = ','.join(attributes)
-            params['attributes'] = attributes
+        params = self._build_search_params(
+            term=term, location=location, latitude=latitude,
+            longitude=longitude, radius=radius, categories=categories,
+            locale=locale, limit=limit, offset=offset, sort_by=sort_by,
+            price=price, open_now=open_now, open_at=open_at,
+            attributes=attributes)
+        return self._do_search(params, maxlimit)
+
+    @staticmethod
+    def _build_search_params(*, term, location, latitude, longitude, radius,
+                             categories, locale, limit, offset, sort_by, price,
+                             open_now, open_at, attributes):
+        """
+        Build the GET parameters for a search query, joining any list or tuple
+        parameters into comma delimited strings.
+
+        """
+
+        params = {}
+        _add_opt(params,
+                 term=term,
+                 limit=limit,
+                 sort_by=sort_by,
+                 location=location,
+                 latitude=latitude if location is None else None,
+                 longitude=longitude if location is None else None,
+                 radius=radius,
+                 categories=_join(categories),
+                 locale=locale,
+                 offset=offset,
+                 price=_join(price),
+                 open_now='true' if open_now else None,
+                 open_at=None if open_now else open_at,
+                 attributes=_join(attributes))
+        return params
+
+    def _do_search(self, params, maxlimit=None):
+        """
+        Query the search endpoint with prebuilt parameters, paginating up to
+        maxlimit results if provided.
+
+        """
 
         # Query Yelp url with parameters and access token provided.
-        url = 'https://api.yelp.com/v3/businesses/search'
-        request = url_query(url, params, self.headers)
-
-        # If more than >50 results have been requested, repeat query until
-        # the desired limit is reached or all possible records have been
-        # retrieved, extending the original results set.
-        if maxlimit is not None:
-            total = request['total']
-            if offset is None:
-                offset = 50
-            while offset < maxlimit and offset < total:
-                params['offset'] = offset
-                results = url_query(url, params, self.headers)
-                if results is not None:
-                    businesses = results['businesses']
-                    if len(businesses) + offset > maxlimit:
-                        businesses = businesses[:maxlimit - offset]
-                    request['businesses'].extend(businesses)
-                offset += 50
+        url = search_url
+        request = self._query(url, params, ttl=search_ttl)
+
+        # Return the first page of results directly, unless more than 50
+        # results have been requested and the first query succeeded.
+        if maxlimit is None or request is None:
+            return request
+
+        # Query the remaining pages until the desired limit is reached or all
+        # possible records have been retrieved, extending the original
+        # results set. Only the total from the first page is needed to know
+        # which offsets to request, so the remaining pages are fetched
+        # concurrently. Each page gets its own copy of the parameters, as the
+        # pages are in flight at the same time.
+        stop = min(maxlimit, request['total'])
+        offsets = range(params.get('offset', 50), stop, 50)
+        pages = [dict(params, offset=page) for page in offsets]
+
+        # Preallocate the full results list and fill it page by page, then
+        # trim any slots left unused by short or failed pages.
+        businesses = request['businesses']
+        cursor = len(businesses)
+        businesses.extend([None] * (stop - cursor))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda page: self._query(url, page, ttl=search_ttl),
+                pages)
+            for offset, result in zip(offsets, results):
+                if result is not None:
+                    page = result['businesses']
+                    if len(page) + offset > maxlimit:
+                        page = page[:maxlimit - offset]
+                    businesses[cursor:cursor + len(page)] = page
+                    cursor += len(page)
+        del businesses[cursor:]
         return request
 
     def phone_search(self, phone):
@@ -359,9 +724,9 @@ class YelpFusion(object):
 
         """
 
-        url = 'https://api.yelp.com/v3/businesses/search/phone'
+        url = phone_search_url
         params = {'phone': phone}
-        request = url_query(url, params, headers=self.headers)
+        request = self._query(url, params, ttl=details_ttl)
         return request
 
     def transaction_search(self, transaction_type='delivery',
@@ -398,10 +763,9 @@ class YelpFusion(object):
 
         params = {}
         if location is not None:
-            params['location'] = location
-        else:
-            params['latitude'] = latitude
-            params['longitude'] = longitude
-        url = 'https://api.yelp.com/v3/transactions/{0}/search'.format(transaction_type)
-        request = url_query(url, params, headers=self.headers)
+            latitude = longitude = None
+        _add_opt(params, location=location, latitude=latitude,
+                 longitude=longitude)
+        url = f'{transactions_url}/{transaction_type}/search'
+        request = self._query(url, params, ttl=transaction_ttl)
         return request